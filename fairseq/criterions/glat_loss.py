@@ -154,6 +154,9 @@ class LabelSmoothedDualImitationCriterion(FairseqCriterion):
         if "glat_context_p" in outputs:
             logging_output['glat_context_p'] = outputs['glat_context_p']
 
+        if "glat_stats" in outputs:
+            logging_output["glat_stats"] = outputs["glat_stats"]
+
         if "glat_anneal" in outputs:
             for i, acc in enumerate(outputs['glat_anneal']):
                 logging_output[f'layer_{i}_acc'] = acc
@@ -186,6 +189,16 @@ class LabelSmoothedDualImitationCriterion(FairseqCriterion):
             "ppl", lambda meters: utils.get_perplexity(meters["loss"].avg)
         )
 
+        if "glat_stats" in logging_outputs[0]:
+            # nat_sd_glat packs (glat_accu, glat_keep, layer_0_acc, ...) into one tensor per logging output,
+            # read them all back with a single transfer; layers skipped by layer drop are NaN
+            all_glat_stats = torch.stack([log["glat_stats"] for log in logging_outputs]).tolist()
+            logging_outputs = [
+                dict(log, glat_accu=stats[0], glat_keep=stats[1],
+                     **{f"layer_{i}_acc": acc for i, acc in enumerate(stats[2:])})
+                for log, stats in zip(logging_outputs, all_glat_stats)
+            ]
+
         metrics.log_scalar(
             "glat_accu", utils.item(np.mean([log.get("glat_accu", 0) for log in logging_outputs])), sample_size, round=3
         )
@@ -208,9 +221,11 @@ class LabelSmoothedDualImitationCriterion(FairseqCriterion):
         for i in range(24):  # NOTE: check up to 24 decoder layers:
             layer_acc_id = f"layer_{i}_acc"
             if layer_acc_id in logging_outputs[0]:
-                [log.get(layer_acc_id, 0) for log in logging_outputs]
+                layer_accs = [log.get(layer_acc_id, 0) for log in logging_outputs]
+                if all(math.isnan(acc) for acc in layer_accs):
+                    continue
                 metrics.log_scalar(
-                    layer_acc_id, utils.item(np.mean([log.get(layer_acc_id, 0) for log in logging_outputs])),
+                    layer_acc_id, utils.item(np.nanmean(layer_accs)),
                     sample_size,
                     round=3
                 )
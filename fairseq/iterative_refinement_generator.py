@@ -511,7 +511,7 @@ class IterativeImitationRefinementGeneratorRankedByBleu(IterativeImitationRefine
             search_results = search_results.to(sample['target'].device)
             # 2. Rank results by bleu
             # 2.1 Get bleu scores per sentence: batch * beam
-            search_results_bleu = self.get_per_sent_bleu_batch_by_beam(sample, search_results, model.ctc_decoder._beam_width)
+            search_results_bleu = self.get_per_sent_bleu_batch_by_beam(sample, search_results, search_results.size(1))
 
             # 2.2 Sort batch
             sorted_search_results, sorted_indices = torch.sort(search_results_bleu, dim=1, descending=True)
@@ -13,7 +13,7 @@ from fairseq.models.transformer import Embedding
 from fairseq.modules.transformer_sentence_encoder import init_bert_params
 from typing import Union
 import logging
-import random, math
+import functools
 from .nat_sd_shared import NATransformerDecoder
 
 logger = logging.getLogger(__name__)
@@ -23,68 +23,78 @@ def _mean_pooling(enc_feats, src_masks):
     # enc_feats: T x B x C
     # src_masks: B x T or None
     if src_masks is None:
-        enc_feats = enc_feats.mean(0)
-    else:
-        src_masks = (~src_masks).transpose(0, 1).type_as(enc_feats)
-        enc_feats = (
-                (enc_feats / src_masks.sum(0)[None, :, None]) * src_masks[:, :, None]
-        ).sum(0)
-    return enc_feats
+        return enc_feats.mean(0)
+    # zero the padding and sum first so only the (B x C) result is divided
+    enc_feats = enc_feats.masked_fill(src_masks.transpose(0, 1)[:, :, None], 0).sum(0)
+    return enc_feats / (~src_masks).sum(1).clamp_min(1)[:, None].type_as(enc_feats)
 
 
 def _argmax(x, dim):
-    return (x == x.max(dim, keepdim=True)[0]).type_as(x)
+    return F.one_hot(x.argmax(dim), x.size(dim)).type_as(x).movedim(-1, dim)
 
 
 def _uniform_assignment(src_lens, trg_lens):
     max_trg_len = trg_lens.max()
-    steps = (src_lens.float() - 1) / (trg_lens.float() - 1)  # step-size
-    # max_trg_len
-    index_t = utils.new_arange(trg_lens, max_trg_len).float()
-    index_t = steps[:, None] * index_t[None, :]  # batch_size X max_trg_len
-    index_t = torch.round(index_t).long().detach()
-    return index_t
+    # round(i * (src_len - 1) / (trg_len - 1)) in integer arithmetic, ties to even like torch.round
+    index_t = utils.new_arange(trg_lens, max_trg_len)
+    num = (src_lens - 1)[:, None] * index_t[None, :]  # batch_size X max_trg_len
+    den = (trg_lens - 1).clamp_min(1)[:, None]
+    index_t, rem = num // den, num % den
+    round_up = (2 * rem > den) | ((2 * rem == den) & (index_t % 2 == 1))
+    return index_t + round_up.long()
 
 
 def _gumbel_softmax(logits, temperature=1.0, withnoise=True, hard=True, eps=1e-10):
-    def sample_gumbel(shape, eps=1e-10):
-        U = torch.rand(shape).cuda()
-        return -torch.log(-torch.log(U + eps) + eps)
-
     if withnoise:
-        gumbels = sample_gumbel(logits.size())
-        y_soft = ((logits + gumbels) * 1.0 / temperature).softmax(2)
+        # -log(E) with E ~ Exp(1) is Gumbel(0, 1), sampled on the device of logits
+        gumbels = torch.empty_like(logits).exponential_().log_().neg_()
+        y_soft = ((logits + gumbels) / temperature).softmax(2)
     else:
-        y_soft = (logits * 1.0 / temperature).softmax(2)
+        y_soft = (logits / temperature).softmax(2)
 
-    index = y_soft.max(dim=-1, keepdim=True)[1]
-    y_hard = torch.zeros_like(logits).scatter_(2, index, 1.0)
-    ret = (y_hard - y_soft).detach() + y_soft
-    if hard:
-        return ret
-    else:
+    if not hard:
         return y_soft
+    y_hard = F.one_hot(y_soft.argmax(-1), y_soft.size(-1)).to(y_soft.dtype)
+    return (y_hard - y_soft).detach() + y_soft
 
 
 @register_model("nat_ctc_sd")
 class NATransformerModel(FairseqNATModel):
     def __init__(self, args, encoder, decoder):
         super().__init__(args, encoder, decoder)
-        from ctcdecode import CTCBeamDecoder
-        self.ctc_decoder = CTCBeamDecoder(
-            decoder.dictionary.symbols,
-            model_path=None,
-            alpha=0,
-            beta=0,
-            cutoff_top_n=40,
-            cutoff_prob=1.0,
-            beam_width=args.ctc_beam_size,
-            num_processes=20,
-            blank_id=decoder.dictionary.blank_index,
-            log_probs_input=False
-        )
         self.inference_decoder_layer = getattr(args, 'inference_decoder_layer', -1)
         self.plain_ctc = getattr(args, 'plain_ctc', False)
+        self.use_gpu_ctc_decoder = getattr(args, 'use_gpu_ctc_decoder', False)
+        if self.plain_ctc:
+            # greedy decoding never touches the beam search decoder, so skip building it
+            self.ctc_decoder = None
+        elif self.use_gpu_ctc_decoder:
+            from torchaudio.models.decoder import cuda_ctc_decoder
+            # the CUDA decoder only supports blank at index 0, so the vocabulary
+            # is permuted to put it first and decoded ids are mapped back
+            blank_index = decoder.dictionary.blank_index
+            vocab_order = [blank_index] + [i for i in range(len(decoder.dictionary)) if i != blank_index]
+            self.register_buffer('gpu_ctc_vocab_order', torch.tensor(vocab_order), persistent=False)
+            self.build_gpu_ctc_decoder = functools.partial(
+                cuda_ctc_decoder,
+                [decoder.dictionary.symbols[i] for i in vocab_order],
+                blank_skip_threshold=0.95
+            )
+            self.gpu_ctc_decoders = {}
+        else:
+            from ctcdecode import CTCBeamDecoder
+            self.ctc_decoder = CTCBeamDecoder(
+                decoder.dictionary.symbols,
+                model_path=None,
+                alpha=0,
+                beta=0,
+                cutoff_top_n=40,
+                cutoff_prob=1.0,
+                beam_width=args.ctc_beam_size,
+                num_processes=20,
+                blank_id=decoder.dictionary.blank_index,
+                log_probs_input=True
+            )
 
     @property
     def allow_length_beam(self):
@@ -125,6 +135,11 @@ class NATransformerModel(FairseqNATModel):
             action='store_true',
             default=False
         )
+        parser.add_argument(
+            '--use-gpu-ctc-decoder',
+            action='store_true',
+            default=False
+        )
         parser.add_argument(
             '--ctc-beam-size',
             default=1,
@@ -250,6 +265,16 @@ class NATransformerModel(FairseqNATModel):
             type=int,
             default=0
         )
+        parser.add_argument(
+            '--compile-decoder',
+            action='store_true',
+            default=False
+        )
+        parser.add_argument(
+            '--allow-tf32',
+            action='store_true',
+            default=False
+        )
 
     @classmethod
     def build_decoder(cls, args, tgt_dict, embed_tokens):
@@ -257,41 +282,56 @@ class NATransformerModel(FairseqNATModel):
         decoder.repeat_layer = getattr(args, 'repeat_layer', 0)
         if getattr(args, "apply_bert_init", False):
             decoder.apply(init_bert_params)
+        if getattr(args, "compile_decoder", False):
+            # fuses the small per-layer ops (output projection, y_hat mixing) of the layer loop;
+            # sequence lengths vary across batches, hence dynamic shapes
+            decoder.forward = torch.compile(decoder.forward, dynamic=True)
         return decoder
 
     def sequence_ctc_loss_with_logits(self,
                                       logits: torch.FloatTensor,
                                       logit_mask: Union[torch.FloatTensor, torch.BoolTensor],
-                                      targets: torch.LongTensor,
-                                      target_mask: Union[torch.FloatTensor, torch.BoolTensor],
+                                      targets: torch.LongTensor = None,
+                                      target_mask: Union[torch.FloatTensor, torch.BoolTensor] = None,
+                                      *,
                                       blank_index: torch.LongTensor,
                                       label_smoothing=0,
-                                      reduce=True
+                                      reduce=True,
+                                      logit_lengths: torch.LongTensor = None,
+                                      target_lengths: torch.LongTensor = None,
+                                      flat_targets: torch.LongTensor = None
                                       ) -> torch.FloatTensor:
         # # lengths : (batch_size, )
         # if self.args.force_ls:  # NOTE temp fix, to really try ls without mess up previous exps
         #     label_smoothing = self.args.label_smoothing
         # else:
         #     label_smoothing = label_smoothing
-        # calculated by counting number of mask
-        logit_lengths = (logit_mask.bool()).long().sum(1)
-
-        if len(targets.size()) == 1:
-            targets = targets.unsqueeze(0)
-            target_mask = target_mask.unsqueeze(0)
-        target_lengths = (target_mask.bool()).long().sum(1)
-
-        # (batch_size, T, n_class)
-        log_probs = logits.log_softmax(-1)
+        # calculated by counting number of mask, unless the caller already did
+        logit_mask = logit_mask.bool()
+        if logit_lengths is None:
+            logit_lengths = logit_mask.long().sum(1)
+
+        # targets / target_mask are only needed when flat_targets / target_lengths are not given
+        if target_lengths is None or flat_targets is None:
+            if len(targets.size()) == 1:
+                targets = targets.unsqueeze(0)
+                target_mask = target_mask.unsqueeze(0)
+            target_mask = target_mask.bool()
+            if target_lengths is None:
+                target_lengths = target_mask.long().sum(1)
+            if flat_targets is None:
+                flat_targets = targets.long()[target_mask]
+
+        # (batch_size, T, n_class), computed in fp32 since ctc_loss has no half-precision kernels;
+        # upcasting inside log_softmax avoids a separate cast over the whole tensor
+        log_probs = logits.log_softmax(-1, dtype=torch.float32)
         # log_probs_T : (T, batch_size, n_class), this kind of shape is required for ctc_loss
         log_probs_T = log_probs.transpose(0, 1)
         #     assert (target_lengths == 0).any()
-        targets = targets.long()
-        targets = targets[target_mask.bool()]
         if reduce:
             loss = F.ctc_loss(
-                log_probs_T.float(),  # compatible with fp16
-                targets,
+                log_probs_T,
+                flat_targets,
                 logit_lengths,
                 target_lengths,
                 blank=blank_index,
@@ -300,26 +340,18 @@ class NATransformerModel(FairseqNATModel):
             )
         else:
             loss = F.ctc_loss(
-                log_probs_T.float(),  # compatible with fp16
-                targets,
+                log_probs_T,
+                flat_targets,
                 logit_lengths,
                 target_lengths,
                 blank=blank_index,
                 reduction="none",
                 zero_infinity=True,
             )
-            loss = torch.stack([a / b for a, b in zip(loss, target_lengths)])
-
-        n_invalid_samples = (logit_lengths < target_lengths).long().sum()
-
-        if n_invalid_samples > 0:
-            logger.warning(
-                f"The length of predicted alignment is shoter than target length, increase upsample factor: {n_invalid_samples} samples"
-            )
-            # raise ValueError
+            loss = loss / target_lengths.to(loss.dtype).clamp_min(1)
 
         if label_smoothing > 0:
-            smoothed_loss = -log_probs.mean(-1)[logit_mask.bool()].mean()
+            smoothed_loss = -log_probs.mean(-1)[logit_mask].mean()
             loss = (1 - label_smoothing) * loss + label_smoothing * smoothed_loss
         return loss
 
@@ -332,6 +364,19 @@ class NATransformerModel(FairseqNATModel):
 
         prev_output_tokens = self.initialize_output_tokens_by_src_tokens(src_tokens)
         prev_output_tokens_mask = prev_output_tokens.ne(self.pad)
+        target_mask = tgt_tokens.ne(self.pad)
+        # shared by every CTC loss call below
+        logit_lengths = prev_output_tokens_mask.long().sum(1)
+        target_lengths = target_mask.long().sum(1)
+        flat_targets = tgt_tokens[target_mask]
+        # counted on the per-sentence lengths, the loss calls below tile them over layers / samples
+        n_invalid_samples = (logit_lengths < target_lengths).long().sum()
+
+        if n_invalid_samples > 0:
+            logger.warning(
+                f"The length of predicted alignment is shoter than target length, increase upsample factor: {n_invalid_samples} samples"
+            )
+            # raise ValueError
 
         # encoding
         encoder_out = self.encoder(src_tokens, src_lengths=src_lengths, **kwargs)
@@ -343,62 +388,65 @@ class NATransformerModel(FairseqNATModel):
             encoder_out=encoder_out,
             train_ratio=train_ratio
         )
-        target_mask = tgt_tokens.ne(self.pad)
 
         if self.args.num_cross_layer_sample != 0:
-            output_logits_list = torch.stack(output_logits_list, dim=0)
-
             N_SAMPLE = self.args.num_cross_layer_sample
 
-            num_decoder_layer = output_logits_list.size(0)
+            num_decoder_layer = len(output_logits_list)
             num_tokens = prev_output_tokens.size(1)
-            num_vocab = output_logits_list.size(-1)
             batch_size = prev_output_tokens.size(0)
 
-            all_sample_ctc_loss = 0
-
-            for sample_id in range(N_SAMPLE):
-                cross_layer_sampled_ids_ts = torch.randint(num_decoder_layer, (batch_size * num_tokens,), device=output_logits_list.device)
-                output_logits_list = output_logits_list.view(num_decoder_layer, -1, num_vocab)
-                gather_idx = cross_layer_sampled_ids_ts.unsqueeze(1).expand(-1, num_vocab).unsqueeze(0)
-                gather_logits = output_logits_list.gather(0, gather_idx).view(batch_size, num_tokens, num_vocab)
-
-                target_mask = tgt_tokens.ne(self.pad)
-                # if self.args.use_ctc:
-                ctc_loss = self.sequence_ctc_loss_with_logits(
-                    logits=gather_logits,
-                    logit_mask=prev_output_tokens_mask,
-                    targets=tgt_tokens,
-                    target_mask=target_mask,
-                    blank_index=self.tgt_dict.blank_index,
-                    label_smoothing=self.args.label_smoothing,
-                    reduce=reduce
-                )
-                all_sample_ctc_loss += ctc_loss
+            # draw the layer of every position for all samples at once
+            cross_layer_sampled_ids_ts = torch.randint(num_decoder_layer, (N_SAMPLE, batch_size, num_tokens, 1),
+                                                       device=prev_output_tokens.device)
+            # select each position's logits from its sampled layer without stacking all the layers,
+            # giving (N_SAMPLE, batch_size, num_tokens, num_vocab)
+            gather_logits = output_logits_list[0]
+            for layer_idx in range(1, num_decoder_layer):
+                gather_logits = torch.where(cross_layer_sampled_ids_ts == layer_idx,
+                                            output_logits_list[layer_idx], gather_logits)
+            gather_logits = gather_logits.expand(N_SAMPLE, -1, -1, -1)
+
+            # if self.args.use_ctc:
+            all_sample_ctc_loss = self.sequence_ctc_loss_with_logits(
+                logits=gather_logits.flatten(0, 1),
+                logit_mask=prev_output_tokens_mask.repeat(N_SAMPLE, 1),
+                blank_index=self.tgt_dict.blank_index,
+                label_smoothing=self.args.label_smoothing,
+                reduce=reduce,
+                logit_lengths=logit_lengths.repeat(N_SAMPLE),
+                target_lengths=target_lengths.repeat(N_SAMPLE),
+                flat_targets=flat_targets.repeat(N_SAMPLE)
+            )
+            # sum over samples, then normalize by the number of layers as before
+            if reduce:
+                all_sample_ctc_loss = all_sample_ctc_loss * N_SAMPLE
+            else:
+                all_sample_ctc_loss = all_sample_ctc_loss.view(N_SAMPLE, -1).sum(0)
 
             ret_val = {
-                "ctc_loss": {"loss": all_sample_ctc_loss / len(output_logits_list)},
+                "ctc_loss": {"loss": all_sample_ctc_loss / num_decoder_layer},
             }
 
         else:
             # if self.args.use_ctc:
-            all_layer_ctc_loss = 0
-            normalized_factor = 0
-            for layer_idx, word_ins_out in enumerate(output_logits_list):
-                ctc_loss = self.sequence_ctc_loss_with_logits(
-                    logits=word_ins_out,
-                    logit_mask=prev_output_tokens_mask,
-                    targets=tgt_tokens,
-                    target_mask=target_mask,
-                    blank_index=self.tgt_dict.blank_index,
-                    label_smoothing=self.args.label_smoothing, #NOTE: enable and double check with it later
-                    reduce=reduce
-                )
-                factor = 1  # math.sqrt(layer_idx + 1)
-                all_layer_ctc_loss += ctc_loss * factor
-                normalized_factor += factor
+            # score all layers with one CTC call over (num_decoder_layer * batch_size) sequences,
+            # which equals averaging the per-layer losses since every layer has the same targets
+            num_decoder_layer = len(output_logits_list)
+            all_layer_ctc_loss = self.sequence_ctc_loss_with_logits(
+                logits=torch.stack(output_logits_list, dim=0).flatten(0, 1),
+                logit_mask=prev_output_tokens_mask.repeat(num_decoder_layer, 1),
+                blank_index=self.tgt_dict.blank_index,
+                label_smoothing=self.args.label_smoothing, #NOTE: enable and double check with it later
+                reduce=reduce,
+                logit_lengths=logit_lengths.repeat(num_decoder_layer),
+                target_lengths=target_lengths.repeat(num_decoder_layer),
+                flat_targets=flat_targets.repeat(num_decoder_layer)
+            )
+            if not reduce:
+                all_layer_ctc_loss = all_layer_ctc_loss.view(num_decoder_layer, -1).mean(0)
             ret_val = {
-                "ctc_loss": {"loss": all_layer_ctc_loss / normalized_factor},
+                "ctc_loss": {"loss": all_layer_ctc_loss},
             }
 
 
@@ -412,9 +460,32 @@ class NATransformerModel(FairseqNATModel):
 
         return ret_val
 
+    def gpu_ctc_decode(self, log_probs, output_length, beam_size):
+        """
+        CTC beam search with the torchaudio CUDA decoder. Returns
+        ``(beam_results, beam_scores, out_lens)`` laid out like the output of
+        ``CTCBeamDecoder.decode``, on the device of *log_probs* and with the
+        positions past ``out_lens`` already filled with pad. Scores follow the
+        ctcdecode convention: negative log-likelihoods, best beam first.
+        """
+        if beam_size not in self.gpu_ctc_decoders:
+            self.gpu_ctc_decoders[beam_size] = self.build_gpu_ctc_decoder(nbest=beam_size, beam_size=beam_size)
+        log_probs = log_probs.index_select(-1, self.gpu_ctc_vocab_order)
+        hyps = self.gpu_ctc_decoders[beam_size](log_probs.float().contiguous(), output_length.int())
+
+        out_lens = torch.tensor([[len(hyp.tokens) for hyp in nbest] for nbest in hyps], device=log_probs.device)
+        beam_scores = torch.tensor([[-hyp.score for hyp in nbest] for nbest in hyps], device=log_probs.device)
+        flat_tokens = [token for nbest in hyps for hyp in nbest for token in hyp.tokens]
+        max_length = max(max(len(hyp.tokens) for hyp in nbest) for nbest in hyps)
+
+        mask = utils.new_arange(out_lens, max(max_length, 1)) < out_lens.unsqueeze(-1)
+        beam_results = out_lens.new_full(mask.size(), self.pad)
+        beam_results[mask] = self.gpu_ctc_vocab_order[
+            torch.tensor(flat_tokens, dtype=torch.long, device=log_probs.device)
+        ]
+        return beam_results, beam_scores, out_lens
+
     def forward_decoder(self, decoder_out, encoder_out, decoding_format=None, **kwargs):
-        # set CTC decoder beam size
-        self.ctc_decoder._beam_width = self.args.ctc_beam_size
         step = decoder_out.step
         output_tokens = decoder_out.output_tokens
         history = decoder_out.history
@@ -434,8 +505,8 @@ class NATransformerModel(FairseqNATModel):
             output_scores = decoder_out.output_scores
             _scores, _tokens = output_logits.max(-1)
             output_masks = output_tokens.ne(self.pad)
-            output_tokens.masked_scatter_(output_masks, _tokens[output_masks])
-            output_scores.masked_scatter_(output_masks, _scores[output_masks])
+            output_tokens = torch.where(output_masks, _tokens, output_tokens)
+            output_scores = torch.where(output_masks, _scores, output_scores)
             if history is not None:
                 history.append(output_tokens.clone())
 
@@ -449,20 +520,29 @@ class NATransformerModel(FairseqNATModel):
             # _scores, _tokens = F.log_softmax(output_logits, -1).max(-1)
             # _scores == beam_results[:,0,:]
             output_length = torch.sum(output_tokens.ne(self.tgt_dict.pad_index), dim=-1)
-            beam_results, beam_scores, timesteps, out_lens = self.ctc_decoder.decode(F.softmax(output_logits, -1),
-                                                                                     output_length)
-            top_beam_tokens = beam_results[:, 0, :]
-            top_beam_len = out_lens[:, 0]
-            mask = torch.arange(0, top_beam_tokens.size(1)).type_as(top_beam_len). \
-                repeat(top_beam_len.size(0), 1).lt(top_beam_len.unsqueeze(1))
-            top_beam_tokens[~mask] = self.decoder.dictionary.pad()
+            if self.use_gpu_ctc_decoder:
+                beam_results, beam_scores, out_lens = self.gpu_ctc_decode(F.log_softmax(output_logits, -1),
+                                                                          output_length, self.args.ctc_beam_size)
+                top_beam_tokens = beam_results[:, 0, :]
+            else:
+                # set CTC decoder beam size
+                if self.ctc_decoder._beam_width != self.args.ctc_beam_size:
+                    self.ctc_decoder._beam_width = self.args.ctc_beam_size
+                beam_results, beam_scores, timesteps, out_lens = self.ctc_decoder.decode(F.log_softmax(output_logits, -1),
+                                                                                         output_length)
+                top_beam_tokens = beam_results[:, 0, :]
+                top_beam_len = out_lens[:, 0]
+                idx = torch.arange(top_beam_tokens.size(1), device=top_beam_len.device)
+                top_beam_tokens.masked_fill_(idx[None, :] >= top_beam_len[:, None], self.decoder.dictionary.pad())
+                # ctcdecode searches on the CPU
+                top_beam_tokens = top_beam_tokens.to(output_logits.device)
             # output_scores.masked_scatter_(output_masks, _scores[output_masks])
             if history is not None:
                 history.append(output_tokens.clone())
 
             return decoder_out._replace(
-                output_tokens=top_beam_tokens.to(output_logits.device),
-                output_scores=torch.full(top_beam_tokens.size(), 1.0),
+                output_tokens=top_beam_tokens,
+                output_scores=output_logits.new_ones(top_beam_tokens.size()),
                 attn=None,
                 history=history,
             )
@@ -471,9 +551,13 @@ class NATransformerModel(FairseqNATModel):
         step = decoder_out.step
         output_tokens = decoder_out.output_tokens
         history = decoder_out.history
+        assert not self.plain_ctc, "CTC beam search is not available with --plain-ctc"
         # Set ctc beam size
-        if beam_size is not None:
-            self.ctc_decoder._beam_width = beam_size
+        if self.use_gpu_ctc_decoder:
+            beam_size = beam_size if beam_size is not None else self.args.ctc_beam_size
+        elif beam_size is not None:
+            if self.ctc_decoder._beam_width != beam_size:
+                self.ctc_decoder._beam_width = beam_size
         else:
             beam_size = self.ctc_decoder._beam_width
 
@@ -487,35 +571,30 @@ class NATransformerModel(FairseqNATModel):
         # _scores, _tokens = F.log_softmax(output_logits, -1).max(-1)
         # _scores == beam_results[:,0,:]
         output_length = torch.sum(output_tokens.ne(self.tgt_dict.pad_index), dim=-1)
-        beam_results, beam_scores, timesteps, out_lens = self.ctc_decoder.decode(F.softmax(output_logits, -1),
+        if self.use_gpu_ctc_decoder:
+            beam_results, beam_scores, _ = self.gpu_ctc_decode(F.log_softmax(output_logits, -1),
+                                                               output_length, beam_size)
+            return beam_results, beam_scores
+
+        beam_results, beam_scores, timesteps, out_lens = self.ctc_decoder.decode(F.log_softmax(output_logits, -1),
                                                                                  output_length)
 
         beam_results = beam_results[:, :, :out_lens.max()]
-        beam_size = beam_scores.size(1)
-        for beam_idx in range(beam_size):
-            top_beam_tokens = beam_results[:, beam_idx, :]
-            top_beam_len = out_lens[:, beam_idx]
-            mask = torch.arange(0, top_beam_tokens.size(1)).type_as(top_beam_len). \
-                repeat(top_beam_len.size(0), 1).lt(top_beam_len.unsqueeze(1))
-            top_beam_tokens[~mask] = self.decoder.dictionary.pad()
+        idx = torch.arange(beam_results.size(2), device=out_lens.device)
+        beam_results.masked_fill_(idx[None, None, :] >= out_lens[:, :, None], self.decoder.dictionary.pad())
         return beam_results, beam_scores
 
     def initialize_output_tokens_by_src_tokens(self, src_tokens):
         if not self.args.copy_src_token:
-            length_tgt = torch.sum(src_tokens.ne(self.tgt_dict.pad_index), -1)
-            if self.args.src_upsample_scale > 2:
-                length_tgt = length_tgt * self.args.src_upsample_scale
-            else:
-                length_tgt = length_tgt * self.args.src_upsample_scale  # + 10
-            max_length = length_tgt.clamp_(min=2).max()
+            length_tgt = src_tokens.ne(self.tgt_dict.pad_index).sum(-1) * self.args.src_upsample_scale
+            length_tgt.clamp_(min=2)
+            # bounded by the padded source width, which avoids syncing on length_tgt.max()
+            max_length = max(2, src_tokens.size(1) * self.args.src_upsample_scale)
             idx_length = utils.new_arange(src_tokens, max_length)
 
-            initial_output_tokens = src_tokens.new_zeros(
-                src_tokens.size(0), max_length
-            ).fill_(self.pad)
-            initial_output_tokens.masked_fill_(
-                idx_length[None, :] < length_tgt[:, None], self.unk
-            )
+            initial_output_tokens = src_tokens.new_full(
+                (src_tokens.size(0), max_length), self.pad
+            ).masked_fill_(idx_length[None, :] < length_tgt[:, None], self.unk)
             initial_output_tokens[:, 0] = self.bos
             initial_output_tokens.scatter_(1, length_tgt[:, None] - 1, self.eos)
             return initial_output_tokens
@@ -556,15 +635,13 @@ class NATransformerModel(FairseqNATModel):
                 - beam_size // 2
         )
         length_tgt = length_tgt.view(-1).clamp_(min=2)
-        max_length = length_tgt.max()
+        # upper bound of length_tgt from the shapes alone, which avoids a device sync
+        max_length = max(2, output_tokens.size(1) + (beam_size - 1) - beam_size // 2)
         idx_length = utils.new_arange(length_tgt, max_length)
 
-        initial_output_tokens = output_tokens.new_zeros(
-            length_tgt.size(0), max_length
-        ).fill_(self.pad)
-        initial_output_tokens.masked_fill_(
-            idx_length[None, :] < length_tgt[:, None], self.unk
-        )
+        initial_output_tokens = output_tokens.new_full(
+            (length_tgt.size(0), max_length), self.pad
+        ).masked_fill_(idx_length[None, :] < length_tgt[:, None], self.unk)
         initial_output_tokens[:, 0] = self.bos
         initial_output_tokens.scatter_(1, length_tgt[:, None] - 1, self.eos)
 
@@ -796,193 +873,59 @@ class NATransformerModel(FairseqNATModel):
 #         return length_tgt
 
 
-@register_model_architecture(
-    "nat_ctc_sd", "nat_ctc_sd"
-)
-def base_architecture(args):
-    args.encoder_embed_path = getattr(args, "encoder_embed_path", None)
-    args.encoder_embed_dim = getattr(args, "encoder_embed_dim", 512)
-    args.encoder_ffn_embed_dim = getattr(args, "encoder_ffn_embed_dim", 2048)
-    args.encoder_layers = getattr(args, "encoder_layers", 6)
-    args.encoder_attention_heads = getattr(args, "encoder_attention_heads", 8)
-    args.encoder_normalize_before = getattr(args, "encoder_normalize_before", False)  # NOTE
-    args.encoder_learned_pos = getattr(args, "encoder_learned_pos", False)
-    args.decoder_embed_path = getattr(args, "decoder_embed_path", None)
-    args.decoder_embed_dim = getattr(args, "decoder_embed_dim", args.encoder_embed_dim)
-    args.decoder_ffn_embed_dim = getattr(
-        args, "decoder_ffn_embed_dim", args.encoder_ffn_embed_dim
-    )
-    args.decoder_layers = getattr(args, "decoder_layers", 6)
-    args.decoder_attention_heads = getattr(args, "decoder_attention_heads", 8)
-    args.decoder_normalize_before = getattr(args, "decoder_normalize_before", False)  # NOTE
-    args.decoder_learned_pos = getattr(args, "decoder_learned_pos", False)
-    args.attention_dropout = getattr(args, "attention_dropout", 0.0)
-    args.activation_dropout = getattr(args, "activation_dropout", 0.0)
-    args.activation_fn = getattr(args, "activation_fn", "relu")
-    args.dropout = getattr(args, "dropout", 0.1)
-    args.adaptive_softmax_cutoff = getattr(args, "adaptive_softmax_cutoff", None)
-    args.adaptive_softmax_dropout = getattr(args, "adaptive_softmax_dropout", 0)
-    args.share_decoder_input_output_embed = getattr(
-        args, "share_decoder_input_output_embed", False
-    )
-    args.share_all_embeddings = getattr(args, "share_all_embeddings", False)
-    args.no_token_positional_embeddings = getattr(
-        args, "no_token_positional_embeddings", False
-    )
-    args.adaptive_input = getattr(args, "adaptive_input", False)
-    args.apply_bert_init = getattr(args, "apply_bert_init", False)
-
-    args.decoder_output_dim = getattr(
-        args, "decoder_output_dim", args.decoder_embed_dim
-    )
-    args.decoder_input_dim = getattr(args, "decoder_input_dim", args.decoder_embed_dim)
-
-    # --- special arguments ---
-    args.sg_length_pred = getattr(args, "sg_length_pred", False)
-    args.pred_length_offset = getattr(args, "pred_length_offset", False)
-    args.length_loss_factor = getattr(args, "length_loss_factor", 0.1)
-    args.src_embedding_copy = getattr(args, "src_embedding_copy", False)
-
-
-@register_model_architecture(
-    "nat_ctc_sd", "nat_ctc_cross_layer_hidden_replace_deep_sup"
-)
-def base_architecture(args):
-    args.encoder_embed_path = getattr(args, "encoder_embed_path", None)
-    args.encoder_embed_dim = getattr(args, "encoder_embed_dim", 512)
-    args.encoder_ffn_embed_dim = getattr(args, "encoder_ffn_embed_dim", 2048)
-    args.encoder_layers = getattr(args, "encoder_layers", 6)
-    args.encoder_attention_heads = getattr(args, "encoder_attention_heads", 8)
-    args.encoder_normalize_before = getattr(args, "encoder_normalize_before", False)  # NOTE
-    args.encoder_learned_pos = getattr(args, "encoder_learned_pos", False)
-    args.decoder_embed_path = getattr(args, "decoder_embed_path", None)
-    args.decoder_embed_dim = getattr(args, "decoder_embed_dim", args.encoder_embed_dim)
-    args.decoder_ffn_embed_dim = getattr(
-        args, "decoder_ffn_embed_dim", args.encoder_ffn_embed_dim
-    )
-    args.decoder_layers = getattr(args, "decoder_layers", 6)
-    args.decoder_attention_heads = getattr(args, "decoder_attention_heads", 8)
-    args.decoder_normalize_before = getattr(args, "decoder_normalize_before", False)  # NOTE
-    args.decoder_learned_pos = getattr(args, "decoder_learned_pos", False)
-    args.attention_dropout = getattr(args, "attention_dropout", 0.0)
-    args.activation_dropout = getattr(args, "activation_dropout", 0.0)
-    args.activation_fn = getattr(args, "activation_fn", "relu")
-    args.dropout = getattr(args, "dropout", 0.1)
-    args.adaptive_softmax_cutoff = getattr(args, "adaptive_softmax_cutoff", None)
-    args.adaptive_softmax_dropout = getattr(args, "adaptive_softmax_dropout", 0)
-    args.share_decoder_input_output_embed = getattr(
-        args, "share_decoder_input_output_embed", False
-    )
-    args.share_all_embeddings = getattr(args, "share_all_embeddings", False)
-    args.no_token_positional_embeddings = getattr(
-        args, "no_token_positional_embeddings", False
-    )
-    args.adaptive_input = getattr(args, "adaptive_input", False)
-    args.apply_bert_init = getattr(args, "apply_bert_init", False)
-
-    args.decoder_output_dim = getattr(
-        args, "decoder_output_dim", args.decoder_embed_dim
-    )
-    args.decoder_input_dim = getattr(args, "decoder_input_dim", args.decoder_embed_dim)
-
+# defaults shared by every nat_ctc_sd architecture, except decoder_layers which
+# differs per architecture and the decoder dimensions derived from other ones
+_NAT_CTC_SD_DEFAULTS = (
+    ("encoder_embed_path", None),
+    ("encoder_embed_dim", 512),
+    ("encoder_ffn_embed_dim", 2048),
+    ("encoder_layers", 6),
+    ("encoder_attention_heads", 8),
+    ("encoder_normalize_before", False),  # NOTE
+    ("encoder_learned_pos", False),
+    ("decoder_embed_path", None),
+    ("decoder_attention_heads", 8),
+    ("decoder_normalize_before", False),  # NOTE
+    ("decoder_learned_pos", False),
+    ("attention_dropout", 0.0),
+    ("activation_dropout", 0.0),
+    ("activation_fn", "relu"),
+    ("dropout", 0.1),
+    ("adaptive_softmax_cutoff", None),
+    ("adaptive_softmax_dropout", 0),
+    ("share_decoder_input_output_embed", False),
+    ("share_all_embeddings", False),
+    ("no_token_positional_embeddings", False),
+    ("adaptive_input", False),
+    ("apply_bert_init", False),
     # --- special arguments ---
-    args.sg_length_pred = getattr(args, "sg_length_pred", False)
-    args.pred_length_offset = getattr(args, "pred_length_offset", False)
-    args.length_loss_factor = getattr(args, "length_loss_factor", 0.1)
-    args.src_embedding_copy = getattr(args, "src_embedding_copy", False)
-
-
-@register_model_architecture(
-    "nat_ctc_sd", "nat_ctc_sd_12d"
+    ("sg_length_pred", False),
+    ("pred_length_offset", False),
+    ("length_loss_factor", 0.1),
+    ("src_embedding_copy", False),
 )
-def base_architecture1(args):
-    args.encoder_embed_path = getattr(args, "encoder_embed_path", None)
-    args.encoder_embed_dim = getattr(args, "encoder_embed_dim", 512)
-    args.encoder_ffn_embed_dim = getattr(args, "encoder_ffn_embed_dim", 2048)
-    args.encoder_layers = getattr(args, "encoder_layers", 6)
-    args.encoder_attention_heads = getattr(args, "encoder_attention_heads", 8)
-    args.encoder_normalize_before = getattr(args, "encoder_normalize_before", False)  # NOTE
-    args.encoder_learned_pos = getattr(args, "encoder_learned_pos", False)
-    args.decoder_embed_path = getattr(args, "decoder_embed_path", None)
-    args.decoder_embed_dim = getattr(args, "decoder_embed_dim", args.encoder_embed_dim)
-    args.decoder_ffn_embed_dim = getattr(
-        args, "decoder_ffn_embed_dim", args.encoder_ffn_embed_dim
-    )
-    args.decoder_layers = getattr(args, "decoder_layers", 12)
-    args.decoder_attention_heads = getattr(args, "decoder_attention_heads", 8)
-    args.decoder_normalize_before = getattr(args, "decoder_normalize_before", False)  # NOTE
-    args.decoder_learned_pos = getattr(args, "decoder_learned_pos", False)
-    args.attention_dropout = getattr(args, "attention_dropout", 0.0)
-    args.activation_dropout = getattr(args, "activation_dropout", 0.0)
-    args.activation_fn = getattr(args, "activation_fn", "relu")
-    args.dropout = getattr(args, "dropout", 0.1)
-    args.adaptive_softmax_cutoff = getattr(args, "adaptive_softmax_cutoff", None)
-    args.adaptive_softmax_dropout = getattr(args, "adaptive_softmax_dropout", 0)
-    args.share_decoder_input_output_embed = getattr(
-        args, "share_decoder_input_output_embed", False
-    )
-    args.share_all_embeddings = getattr(args, "share_all_embeddings", False)
-    args.no_token_positional_embeddings = getattr(
-        args, "no_token_positional_embeddings", False
-    )
-    args.adaptive_input = getattr(args, "adaptive_input", False)
-    args.apply_bert_init = getattr(args, "apply_bert_init", False)
 
-    args.decoder_output_dim = getattr(
-        args, "decoder_output_dim", args.decoder_embed_dim
-    )
-    args.decoder_input_dim = getattr(args, "decoder_input_dim", args.decoder_embed_dim)
 
-    # --- special arguments ---
-    args.sg_length_pred = getattr(args, "sg_length_pred", False)
-    args.pred_length_offset = getattr(args, "pred_length_offset", False)
-    args.length_loss_factor = getattr(args, "length_loss_factor", 0.1)
-    args.src_embedding_copy = getattr(args, "src_embedding_copy", False)
+def base_architecture(args, decoder_layers=6):
+    d = vars(args)
+    d.setdefault("decoder_layers", decoder_layers)
+    for name, default in _NAT_CTC_SD_DEFAULTS:
+        d.setdefault(name, default)
+    decoder_embed_dim = d.setdefault("decoder_embed_dim", d["encoder_embed_dim"])
+    d.setdefault("decoder_ffn_embed_dim", d["encoder_ffn_embed_dim"])
+    d.setdefault("decoder_output_dim", decoder_embed_dim)
+    d.setdefault("decoder_input_dim", decoder_embed_dim)
 
 
-@register_model_architecture(
-    "nat_ctc_sd", "nat_ctc_sd_de_24d"
+# (architecture name, default number of decoder layers)
+_NAT_CTC_SD_ARCHS = (
+    ("nat_ctc_sd", 6),
+    ("nat_ctc_cross_layer_hidden_replace_deep_sup", 6),
+    ("nat_ctc_sd_12d", 12),
+    ("nat_ctc_sd_de_24d", 24),
 )
-def base_architecture2(args):
-    args.encoder_embed_path = getattr(args, "encoder_embed_path", None)
-    args.encoder_embed_dim = getattr(args, "encoder_embed_dim", 512)
-    args.encoder_ffn_embed_dim = getattr(args, "encoder_ffn_embed_dim", 2048)
-    args.encoder_layers = getattr(args, "encoder_layers", 6)
-    args.encoder_attention_heads = getattr(args, "encoder_attention_heads", 8)
-    args.encoder_normalize_before = getattr(args, "encoder_normalize_before", False)  # NOTE
-    args.encoder_learned_pos = getattr(args, "encoder_learned_pos", False)
-    args.decoder_embed_path = getattr(args, "decoder_embed_path", None)
-    args.decoder_embed_dim = getattr(args, "decoder_embed_dim", args.encoder_embed_dim)
-    args.decoder_ffn_embed_dim = getattr(
-        args, "decoder_ffn_embed_dim", args.encoder_ffn_embed_dim
-    )
-    args.decoder_layers = getattr(args, "decoder_layers", 24)
-    args.decoder_attention_heads = getattr(args, "decoder_attention_heads", 8)
-    args.decoder_normalize_before = getattr(args, "decoder_normalize_before", False)  # NOTE
-    args.decoder_learned_pos = getattr(args, "decoder_learned_pos", False)
-    args.attention_dropout = getattr(args, "attention_dropout", 0.0)
-    args.activation_dropout = getattr(args, "activation_dropout", 0.0)
-    args.activation_fn = getattr(args, "activation_fn", "relu")
-    args.dropout = getattr(args, "dropout", 0.1)
-    args.adaptive_softmax_cutoff = getattr(args, "adaptive_softmax_cutoff", None)
-    args.adaptive_softmax_dropout = getattr(args, "adaptive_softmax_dropout", 0)
-    args.share_decoder_input_output_embed = getattr(
-        args, "share_decoder_input_output_embed", False
-    )
-    args.share_all_embeddings = getattr(args, "share_all_embeddings", False)
-    args.no_token_positional_embeddings = getattr(
-        args, "no_token_positional_embeddings", False
-    )
-    args.adaptive_input = getattr(args, "adaptive_input", False)
-    args.apply_bert_init = getattr(args, "apply_bert_init", False)
 
-    args.decoder_output_dim = getattr(
-        args, "decoder_output_dim", args.decoder_embed_dim
+for _arch_name, _decoder_layers in _NAT_CTC_SD_ARCHS:
+    register_model_architecture("nat_ctc_sd", _arch_name)(
+        functools.partial(base_architecture, decoder_layers=_decoder_layers)
     )
-    args.decoder_input_dim = getattr(args, "decoder_input_dim", args.decoder_embed_dim)
-
-    # --- special arguments ---
-    args.sg_length_pred = getattr(args, "sg_length_pred", False)
-    args.pred_length_offset = getattr(args, "pred_length_offset", False)
-    args.length_loss_factor = getattr(args, "length_loss_factor", 0.1)
-    args.src_embedding_copy = getattr(args, "src_embedding_copy", False)
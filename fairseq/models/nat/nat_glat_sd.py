@@ -26,13 +26,10 @@ def _mean_pooling(enc_feats, src_masks):
     # enc_feats: T x B x C
     # src_masks: B x T or None
     if src_masks is None:
-        enc_feats = enc_feats.mean(0)
-    else:
-        src_masks = (~src_masks).transpose(0, 1).type_as(enc_feats)
-        enc_feats = (
-                (enc_feats / src_masks.sum(0)[None, :, None]) * src_masks[:, :, None]
-        ).sum(0)
-    return enc_feats
+        return enc_feats.mean(0)
+    # zero the padding and sum first so only the (B x C) result is divided
+    enc_feats = enc_feats.masked_fill(src_masks.transpose(0, 1)[:, :, None], 0).sum(0)
+    return enc_feats / (~src_masks).sum(1).clamp_min(1)[:, None].type_as(enc_feats)
 
 
 def _argmax(x, dim):
@@ -41,12 +38,13 @@ def _argmax(x, dim):
 
 def _uniform_assignment(src_lens, trg_lens):
     max_trg_len = trg_lens.max()
-    steps = (src_lens.float() - 1) / (trg_lens.float() - 1)  # step-size
-    # max_trg_len
-    index_t = utils.new_arange(trg_lens, max_trg_len).float()
-    index_t = steps[:, None] * index_t[None, :]  # batch_size X max_trg_len
-    index_t = torch.round(index_t).long().detach()
-    return index_t
+    # round(i * (src_len - 1) / (trg_len - 1)) in integer arithmetic, ties to even like torch.round
+    index_t = utils.new_arange(trg_lens, max_trg_len)
+    num = (src_lens - 1)[:, None] * index_t[None, :]  # batch_size X max_trg_len
+    den = (trg_lens - 1).clamp_min(1)[:, None]
+    index_t, rem = num // den, num % den
+    round_up = (2 * rem > den) | ((2 * rem == den) & (index_t % 2 == 1))
+    return index_t + round_up.long()
 
 
 @register_model("nat_sd_glat")
@@ -193,12 +191,26 @@ class NATransformerModel(FairseqNATModel):
             type=float,
             default=0
         )
+        parser.add_argument(
+            '--compile-decoder',
+            action='store_true',
+            default=False
+        )
+        parser.add_argument(
+            '--allow-tf32',
+            action='store_true',
+            default=False
+        )
 
     @classmethod
     def build_decoder(cls, args, tgt_dict, embed_tokens):
         decoder = NATransformerDecoder(args, tgt_dict, embed_tokens)
         if getattr(args, "apply_bert_init", False):
             decoder.apply(init_bert_params)
+        if getattr(args, "compile_decoder", False):
+            # same as nat_ctc_sd: the layer loop branches on the sampling option and
+            # sequence lengths vary across batches, so compile with dynamic shapes
+            decoder.forward = torch.compile(decoder.forward, dynamic=True)
         return decoder
 
     def forward(
@@ -222,55 +234,70 @@ class NATransformerModel(FairseqNATModel):
         rand_seed = random.randint(0, 19260817)
         # decoding
         glat_info = None
-        anneal_info = None
+        word_ins_out_list = None
         if glat and tgt_tokens is not None:
             if "context_p" in glat:
-                with torch.no_grad():
+                # when the decoder input is copied from the source, the glanced target tokens
+                # are never embedded and the seeded training pass would repeat the glancing one
+                if (self.decoder.src_embedding_copy or self.decoder.softcopy) and \
+                        (train_ratio is None or not self.decoder.temp_anneal):
                     with torch_seed(rand_seed):
                         word_ins_out_list = self.decoder(
                             normalize=False,
                             prev_output_tokens=prev_output_tokens,
                             encoder_out=encoder_out,
-                            train_ratio=train_ratio
                         )
-                    pred_tokens = word_ins_out_list[-1].argmax(-1)
+                    glancing_out_list = word_ins_out_list
+                with torch.no_grad():
+                    if word_ins_out_list is None:
+                        with torch_seed(rand_seed):
+                            glancing_out_list = self.decoder(
+                                normalize=False,
+                                prev_output_tokens=prev_output_tokens,
+                                encoder_out=encoder_out,
+                                train_ratio=train_ratio
+                            )
+                    pred_tokens = glancing_out_list[-1].argmax(-1)
                     nonpad_positions = tgt_mask
                     same_num = ((pred_tokens == tgt_tokens) & nonpad_positions).sum(1)
                     seq_lens = (nonpad_positions).sum(1)
                     keep_prob = ((seq_lens - same_num) / seq_lens * glat['context_p']).unsqueeze(-1)
                     # keep: True, drop: False
-                    keep_word_mask = (torch.rand(prev_output_tokens.shape,
-                                                 device=word_ins_out_list[-1].device) < keep_prob).bool()
-                    glat_prev_output_tokens = prev_output_tokens.masked_fill(keep_word_mask,
-                                                                             0) + tgt_tokens.masked_fill(
-                        ~keep_word_mask, 0)
+                    keep_word_mask = torch.rand(prev_output_tokens.shape,
+                                                device=glancing_out_list[-1].device) < keep_prob
+                    glat_prev_output_tokens = torch.where(keep_word_mask, tgt_tokens, prev_output_tokens)
                     glat_tgt_tokens = tgt_tokens.masked_fill(keep_word_mask, self.pad)
 
                     prev_output_tokens, tgt_tokens = glat_prev_output_tokens, glat_tgt_tokens
 
+                    # num_layers x B, stacking the predictions rather than the logits
+                    all_layer_pred_tokens = torch.stack([x.argmax(-1) for x in glancing_out_list])
+                    all_layer_acc = torch.div(
+                        torch.sum((all_layer_pred_tokens == tgt_tokens) & tgt_mask, dim=-1,
+                                  dtype=glancing_out_list[-1].dtype),
+                        torch.sum(tgt_mask, dim=-1))
+
+                    # (glat_accu, glat_keep, layer_0_acc, ...) packed in one tensor that stays on device
+                    # until the criterion reduces the logging outputs; layer drop may return fewer layers,
+                    # so the per-layer slots are padded with NaN to keep the size fixed at 2 + num_layers
+                    layer_acc = all_layer_acc.mean(-1).float()
+                    layer_acc = F.pad(layer_acc, (0, self.decoder.num_layers - layer_acc.size(0)),
+                                      value=float("nan"))
                     glat_info = {
-                        "glat_accu": (same_num.sum() / seq_lens.sum()).item(),
                         "glat_context_p": glat['context_p'],
-                        "glat_keep": keep_prob.mean().item()
+                        "glat_stats": torch.cat([
+                            torch.stack([same_num.sum() / seq_lens.sum(), keep_prob.mean()]),
+                            layer_acc,
+                        ]),
                     }
 
-                    all_layer_acc_list = []
-                    for per_layer_output_logits in word_ins_out_list:
-                        per_layer_acc = torch.div(
-                            torch.sum((per_layer_output_logits.argmax(-1) == tgt_tokens) & tgt_mask, dim=-1,
-                                      dtype=per_layer_output_logits.dtype),
-                            torch.sum(tgt_mask, dim=-1))
-                        all_layer_acc_list.append(per_layer_acc)
-                    anneal_info = {
-                        "glat_anneal": [torch.mean(x).item() for x in all_layer_acc_list]
-                    }
-
-        with torch_seed(rand_seed):
-            word_ins_out_list = self.decoder(
-                normalize=False,
-                prev_output_tokens=prev_output_tokens,
-                encoder_out=encoder_out,
-            )
+        if word_ins_out_list is None:
+            with torch_seed(rand_seed):
+                word_ins_out_list = self.decoder(
+                    normalize=False,
+                    prev_output_tokens=prev_output_tokens,
+                    encoder_out=encoder_out,
+                )
 
         if self.args.length_ls:
             ret_val = {
@@ -303,8 +330,6 @@ class NATransformerModel(FairseqNATModel):
 
         if glat_info is not None:
             ret_val.update(glat_info)
-        if anneal_info is not None:
-            ret_val.update(anneal_info)
         return ret_val
 
     def forward_decoder(self, decoder_out, encoder_out, decoding_format=None, **kwargs):
@@ -328,8 +353,8 @@ class NATransformerModel(FairseqNATModel):
 
         _scores, _tokens = output_logits.max(-1)
 
-        output_tokens.masked_scatter_(output_masks, _tokens[output_masks])
-        output_scores.masked_scatter_(output_masks, _scores[output_masks])
+        output_tokens = torch.where(output_masks, _tokens, output_tokens)
+        output_scores = torch.where(output_masks, _scores, output_scores)
         if history is not None:
             history.append(output_tokens.clone())
 
@@ -350,12 +375,9 @@ class NATransformerModel(FairseqNATModel):
         max_length = length_tgt.clamp_(min=2).max()
         idx_length = utils.new_arange(src_tokens, max_length)
 
-        initial_output_tokens = src_tokens.new_zeros(
-            src_tokens.size(0), max_length
-        ).fill_(self.pad)
-        initial_output_tokens.masked_fill_(
-            idx_length[None, :] < length_tgt[:, None], self.unk
-        )
+        initial_output_tokens = src_tokens.new_full(
+            (src_tokens.size(0), max_length), self.pad
+        ).masked_fill_(idx_length[None, :] < length_tgt[:, None], self.unk)
         initial_output_tokens[:, 0] = self.bos
         initial_output_tokens.scatter_(1, length_tgt[:, None] - 1, self.eos)
 
@@ -384,12 +406,9 @@ class NATransformerModel(FairseqNATModel):
         max_length = length_tgt.max()
         idx_length = utils.new_arange(length_tgt, max_length)
 
-        initial_output_tokens = output_tokens.new_zeros(
-            length_tgt.size(0), max_length
-        ).fill_(self.pad)
-        initial_output_tokens.masked_fill_(
-            idx_length[None, :] < length_tgt[:, None], self.unk
-        )
+        initial_output_tokens = output_tokens.new_full(
+            (length_tgt.size(0), max_length), self.pad
+        ).masked_fill_(idx_length[None, :] < length_tgt[:, None], self.unk)
         initial_output_tokens[:, 0] = self.bos
         initial_output_tokens.scatter_(1, length_tgt[:, None] - 1, self.eos)
 
@@ -12,6 +12,9 @@ from fairseq.models.nat import FairseqNATSharedDecoder, FairseqNATModel, ensembl
 from fairseq.models.transformer import Embedding
 from fairseq.modules.transformer_sentence_encoder import init_bert_params
 import numpy as np
+import math
+
+INV_SQRT2 = 1.0 / math.sqrt(2.0)
 
 class ModifiedLayerDropModuleList(torch.nn.ModuleList):
     # Note, this will also return index
@@ -49,17 +52,13 @@ class ModifiedLayerDropModuleList(torch.nn.ModuleList):
 
 
 def _gumbel_softmax(logits, tau=1, hard=False, eps=1e-10, dim=-1):
-    _device = logits.device
-    _dtype = logits.dtype
-    gumebel_dist = torch.distributions.gumbel.Gumbel(torch.tensor(0., device=_device, dtype=_dtype),
-                                                     torch.tensor(1., device=_device, dtype=_dtype))
-    y_soft = torch.softmax(
-        (logits + gumebel_dist.sample(logits.size())) / tau, dim=-1)
+    # -log(E) with E ~ Exp(1) is Gumbel(0, 1)
+    gumbels = torch.empty_like(logits).exponential_().log_().neg_()
+    y_soft = torch.softmax((logits + gumbels) / tau, dim=-1)
 
     if hard:
         # Straight through.
-        index = y_soft.max(dim, keepdim=True)[1]
-        y_hard = torch.zeros_like(logits).scatter_(dim, index, 1.0)
+        y_hard = F.one_hot(y_soft.argmax(dim), y_soft.size(dim)).type_as(y_soft).movedim(-1, dim)
         ret = y_hard - y_soft.detach() + y_soft
     else:
         # Reparametrization trick.
@@ -71,27 +70,25 @@ def _mean_pooling(enc_feats, src_masks):
     # enc_feats: T x B x C
     # src_masks: B x T or None
     if src_masks is None:
-        enc_feats = enc_feats.mean(0)
-    else:
-        src_masks = (~src_masks).transpose(0, 1).type_as(enc_feats)
-        enc_feats = (
-            (enc_feats / src_masks.sum(0)[None, :, None]) * src_masks[:, :, None]
-        ).sum(0)
-    return enc_feats
+        return enc_feats.mean(0)
+    # zero the padding and sum first so only the (B x C) result is divided
+    enc_feats = enc_feats.masked_fill(src_masks.transpose(0, 1)[:, :, None], 0).sum(0)
+    return enc_feats / (~src_masks).sum(1).clamp_min(1)[:, None].type_as(enc_feats)
 
 
 def _argmax(x, dim):
-    return (x == x.max(dim, keepdim=True)[0]).type_as(x)
+    return F.one_hot(x.argmax(dim), x.size(dim)).type_as(x).movedim(-1, dim)
 
 
 def _uniform_assignment(src_lens, trg_lens):
     max_trg_len = trg_lens.max()
-    steps = (src_lens.float() - 1) / (trg_lens.float() - 1)  # step-size
-    # max_trg_len
-    index_t = utils.new_arange(trg_lens, max_trg_len).float()
-    index_t = steps[:, None] * index_t[None, :]  # batch_size X max_trg_len
-    index_t = torch.round(index_t).long().detach()
-    return index_t
+    # round(i * (src_len - 1) / (trg_len - 1)) in integer arithmetic, ties to even like torch.round
+    index_t = utils.new_arange(trg_lens, max_trg_len)
+    num = (src_lens - 1)[:, None] * index_t[None, :]  # batch_size X max_trg_len
+    den = (trg_lens - 1).clamp_min(1)[:, None]
+    index_t, rem = num // den, num % den
+    round_up = (2 * rem > den) | ((2 * rem == den) & (index_t % 2 == 1))
+    return index_t + round_up.long()
 
 
 @register_model("nat_sd_shared")
@@ -153,6 +150,11 @@ class NATransformerModel(FairseqNATModel):
             action='store_true',
             default=False
         )
+        parser.add_argument(
+            '--allow-tf32',
+            action='store_true',
+            default=False
+        )
 
     @classmethod
     def build_decoder(cls, args, tgt_dict, embed_tokens):
@@ -217,8 +219,8 @@ class NATransformerModel(FairseqNATModel):
             step=step,
         )[-1].max(-1)
 
-        output_tokens.masked_scatter_(output_masks, _tokens[output_masks])
-        output_scores.masked_scatter_(output_masks, _scores[output_masks])
+        output_tokens = torch.where(output_masks, _tokens, output_tokens)
+        output_scores = torch.where(output_masks, _scores, output_scores)
         if history is not None:
             history.append(output_tokens.clone())
 
@@ -279,12 +281,9 @@ class NATransformerModel(FairseqNATModel):
         max_length = length_tgt.clamp_(min=2).max()
         idx_length = utils.new_arange(src_tokens, max_length)
 
-        initial_output_tokens = src_tokens.new_zeros(
-            src_tokens.size(0), max_length
-        ).fill_(self.pad)
-        initial_output_tokens.masked_fill_(
-            idx_length[None, :] < length_tgt[:, None], self.unk
-        )
+        initial_output_tokens = src_tokens.new_full(
+            (src_tokens.size(0), max_length), self.pad
+        ).masked_fill_(idx_length[None, :] < length_tgt[:, None], self.unk)
         initial_output_tokens[:, 0] = self.bos
         initial_output_tokens.scatter_(1, length_tgt[:, None] - 1, self.eos)
 
@@ -313,12 +312,9 @@ class NATransformerModel(FairseqNATModel):
         max_length = length_tgt.max()
         idx_length = utils.new_arange(length_tgt, max_length)
 
-        initial_output_tokens = output_tokens.new_zeros(
-            length_tgt.size(0), max_length
-        ).fill_(self.pad)
-        initial_output_tokens.masked_fill_(
-            idx_length[None, :] < length_tgt[:, None], self.unk
-        )
+        initial_output_tokens = output_tokens.new_full(
+            (length_tgt.size(0), max_length), self.pad
+        ).masked_fill_(idx_length[None, :] < length_tgt[:, None], self.unk)
         initial_output_tokens[:, 0] = self.bos
         initial_output_tokens.scatter_(1, length_tgt[:, None] - 1, self.eos)
 
@@ -381,10 +377,20 @@ class NATransformerDecoder(FairseqNATSharedDecoder):
         self.all_layers = ModifiedLayerDropModuleList(self.layer_drop_ratio, self.layers)
 
         self.yhat_posemb = getattr(args, 'yhat_posemb', False)
+        self.sample_option = getattr(args, 'sample_option', 'hard')
+        self.softmax_temp = getattr(args, 'softmax_temp', 1)
+        self.temp_anneal = getattr(args, 'temp_anneal', False)
+        self.num_topk = getattr(args, 'num_topk', 1)
+        self.force_detach = getattr(args, 'force_detach', False)
 
         self.length_dropout = getattr(args, 'length_dropout', 0.0)
         # self.repeat_layer = getattr(args, 'repeat_layer', 0)
 
+        if getattr(args, 'allow_tf32', False):
+            # run the fp32 vocabulary projections and attention matmuls on TF32 tensor cores
+            torch.backends.cuda.matmul.allow_tf32 = True
+            torch.backends.cudnn.allow_tf32 = True
+
     @ensemble_decoder
     def forward(self, normalize, encoder_out, prev_output_tokens, step=0, train_ratio=None, **unused):
         _, all_features = self.extract_features(
@@ -503,88 +509,89 @@ class NATransformerDecoder(FairseqNATSharedDecoder):
             if (early_exit is not None) and (i >= early_exit):
                 break
             # x_size = x.size()
-            layer_out_logits = self.output_layer(x)
-            # layer_out_logits =  torch.matmul(x.reshape(-1, x_size[-1]), self.output_projection.weight.detach().transpose(0, 1)).view(x_size[0], x_size[1], -1)
+            if not is_first_layer_separately_calculated and i == 0:
+                # the first layer takes the embeddings as is, no y_hat is needed
+                new_x = x
+            else:
+                layer_out_logits = self.output_layer(x)
+                # layer_out_logits =  torch.matmul(x.reshape(-1, x_size[-1]), self.output_projection.weight.detach().transpose(0, 1)).view(x_size[0], x_size[1], -1)
 
-            # Note: training time
-            if self.training:
-                if train_ratio is not None and self.args.temp_anneal:
-                    softmax_temp = train_ratio * 10 + 1
-                else:
-                    softmax_temp = self.args.softmax_temp
-
-                if self.args.sample_option == 'softmax_sample':
-                    with torch.no_grad():
-                        samples = torch.multinomial(torch.softmax(layer_out_logits.detach() *
-                                                                  softmax_temp, dim=-1).
-                                                    view(-1, layer_out_logits.size(-1)), 1)
-                    layer_out = self.embed_tokens(samples.view(-1)).view(x.size())
-                elif self.args.sample_option == 'gumbel_st':
-                    samples = _gumbel_softmax(layer_out_logits, tau=1 / softmax_temp,
-                                              hard=True).view(-1, layer_out_logits.size(-1))
-                    # samples = torch.softmax(layer_out_logits.detach() * self.args.softmax_temp, dim=-1).view(-1, layer_out_logits.size(-1))
-
-                    layer_out = torch.matmul(samples, self.embed_tokens.weight).view(x.size())
-
-                elif self.args.sample_option == 'gumbel_sm':
-                    samples = _gumbel_softmax(layer_out_logits, tau=1 / softmax_temp,
-                                              hard=False).view(-1, layer_out_logits.size(-1))
-                    layer_out = torch.matmul(samples, self.embed_tokens.weight).view(x.size())
-                # elif self.args.sample_option == 'softmax_sample':
-                #     layer_out = self.embed_tokens(layer_out_logits.argmax(dim=-1))
-                elif self.args.sample_option == 'topk':
-                    bsz = x.size(0) * x.size(1)
-                    with torch.no_grad():
-                        topk_val, topk_idx = torch.topk(layer_out_logits, self.args.num_topk, sorted=False, dim=-1)
-                        topk_k_weight = torch.softmax(topk_val * softmax_temp, dim=-1)
-                    layer_out = torch.bmm(topk_k_weight.view(bsz, 1, self.args.num_topk),
-                                          self.embed_tokens(topk_idx).view(bsz, self.args.num_topk, -1)).view(
-                        x.size())
-                elif self.args.sample_option == 'softmax_ss':
-                    if self.args.force_detach:
-                        with torch.no_grad():
-                            weights = torch.softmax(layer_out_logits.detach() * softmax_temp,
-                                                    dim=-1).view(-1, layer_out_logits.size(-1))
-                        layer_out = torch.matmul(weights, self.embed_tokens.weight).view(x.size())
+                # Note: training time
+                if self.training:
+                    if train_ratio is not None and self.temp_anneal:
+                        softmax_temp = train_ratio * 10 + 1
                     else:
-                        layer_out = torch.matmul(
-                            torch.softmax(layer_out_logits * softmax_temp,
-                                          dim=-1).view(-1, layer_out_logits.size(-1)),
-                            self.embed_tokens.weight).view(x.size())
-                elif self.args.sample_option == 'hard':
-                    if self.yhat_posemb:
-                        layer_out = self.forward_embedding(layer_out_logits.argmax(dim=-1).transpose(0, 1))[0].transpose(0, 1)
+                        softmax_temp = self.softmax_temp
+
+                    if self.sample_option == 'softmax_sample':
+                        with torch.no_grad():
+                            samples = torch.multinomial(torch.softmax(layer_out_logits.detach() *
+                                                                      softmax_temp, dim=-1).
+                                                        view(-1, layer_out_logits.size(-1)), 1)
+                        layer_out = self.embed_tokens(samples.view(-1)).view(x.size())
+                    elif self.sample_option == 'gumbel_st':
+                        samples = _gumbel_softmax(layer_out_logits, tau=1 / softmax_temp,
+                                                  hard=True).view(-1, layer_out_logits.size(-1))
+                        # samples = torch.softmax(layer_out_logits.detach() * self.args.softmax_temp, dim=-1).view(-1, layer_out_logits.size(-1))
+
+                        layer_out = torch.matmul(samples, self.embed_tokens.weight).view(x.size())
+
+                    elif self.sample_option == 'gumbel_sm':
+                        samples = _gumbel_softmax(layer_out_logits, tau=1 / softmax_temp,
+                                                  hard=False).view(-1, layer_out_logits.size(-1))
+                        layer_out = torch.matmul(samples, self.embed_tokens.weight).view(x.size())
+                    # elif self.args.sample_option == 'softmax_sample':
+                    #     layer_out = self.embed_tokens(layer_out_logits.argmax(dim=-1))
+                    elif self.sample_option == 'topk':
+                        bsz = x.size(0) * x.size(1)
+                        with torch.no_grad():
+                            topk_val, topk_idx = torch.topk(layer_out_logits, self.num_topk, sorted=False, dim=-1)
+                            topk_k_weight = torch.softmax(topk_val * softmax_temp, dim=-1)
+                        layer_out = torch.bmm(topk_k_weight.view(bsz, 1, self.num_topk),
+                                              self.embed_tokens(topk_idx).view(bsz, self.num_topk, -1)).view(
+                            x.size())
+                    elif self.sample_option == 'softmax_ss':
+                        if self.force_detach:
+                            with torch.no_grad():
+                                weights = torch.softmax(layer_out_logits.detach() * softmax_temp,
+                                                        dim=-1).view(-1, layer_out_logits.size(-1))
+                            layer_out = torch.matmul(weights, self.embed_tokens.weight).view(x.size())
+                        else:
+                            layer_out = torch.matmul(
+                                torch.softmax(layer_out_logits * softmax_temp,
+                                              dim=-1).view(-1, layer_out_logits.size(-1)),
+                                self.embed_tokens.weight).view(x.size())
+                    elif self.sample_option == 'hard':
+                        if self.yhat_posemb:
+                            layer_out = self.forward_embedding(layer_out_logits.argmax(dim=-1).transpose(0, 1))[0].transpose(0, 1)
+                        else:
+                            layer_out = self.embed_tokens(layer_out_logits.argmax(dim=-1))
                     else:
-                        layer_out = self.embed_tokens(layer_out_logits.argmax(dim=-1))
+                        raise NotImplementedError
+                # NOTE: inference time
                 else:
-                    raise NotImplementedError
-            # NOTE: inference time
-            else:
-                if self.args.temp_anneal or self.args.sample_option in ['hard', 'gumbel_st', 'gumbel_sm', 'softmax_sample']:
-                    if self.yhat_posemb:
-                        layer_out = self.forward_embedding(layer_out_logits.argmax(dim=-1).transpose(0, 1))[0].transpose(0, 1)
+                    if self.temp_anneal or self.sample_option in ['hard', 'gumbel_st', 'gumbel_sm', 'softmax_sample']:
+                        if self.yhat_posemb:
+                            layer_out = self.forward_embedding(layer_out_logits.argmax(dim=-1).transpose(0, 1))[0].transpose(0, 1)
+                        else:
+                            layer_out = self.embed_tokens(layer_out_logits.argmax(dim=-1))
+                    elif self.sample_option == 'topk':
+                        bsz = x.size(0) * x.size(1)
+                        topk_val, topk_idx = torch.topk(layer_out_logits, self.num_topk, sorted=False, dim=-1)
+                        topk_k_weight = torch.softmax(topk_val * self.softmax_temp, dim=-1)
+                        layer_out = torch.bmm(topk_k_weight.view(bsz, 1, self.num_topk),
+                                              self.embed_tokens(topk_idx).view(bsz, self.num_topk, -1)).view(
+                            x.size())
+                    elif self.sample_option == 'softmax_ss':
+                        weights = torch.softmax(layer_out_logits * self.softmax_temp,
+                                                dim=-1).view(-1, layer_out_logits.size(-1))
+                        layer_out = torch.matmul(weights, self.embed_tokens.weight).view(x.size())
                     else:
-                        layer_out = self.embed_tokens(layer_out_logits.argmax(dim=-1))
-                elif self.args.sample_option == 'topk':
-                    bsz = x.size(0) * x.size(1)
-                    topk_val, topk_idx = torch.topk(layer_out_logits, self.args.num_topk, sorted=False, dim=-1)
-                    topk_k_weight = torch.softmax(topk_val * self.args.softmax_temp, dim=-1)
-                    layer_out = torch.bmm(topk_k_weight.view(bsz, 1, self.args.num_topk),
-                                          self.embed_tokens(topk_idx).view(bsz, self.args.num_topk, -1)).view(
-                        x.size())
-                elif self.args.sample_option == 'softmax_ss':
-                    weights = torch.softmax(layer_out_logits * self.args.softmax_temp,
-                                            dim=-1).view(-1, layer_out_logits.size(-1))
-                    layer_out = torch.matmul(weights, self.embed_tokens.weight).view(x.size())
-                else:
-                    raise NotImplementedError
+                        raise NotImplementedError
 
-            if not is_first_layer_separately_calculated and i == 0:
-                new_x = x
-            else:
                 all_layer_output_logits.append(layer_out_logits)
                 if not self.concat_yhat:
-                    new_x = (x + layer_out) / torch.sqrt(torch.tensor(2.))
+                    new_x = (x + layer_out) * INV_SQRT2
                 else:
                     new_x = torch.cat((x, layer_out), dim=-1)
                     if self.concat_dropout is not None:
@@ -9,7 +9,7 @@ from fairseq import utils
 from fairseq.iterative_refinement_generator import DecoderOut
 from fairseq.models import register_model, register_model_architecture
 from fairseq.modules.transformer_sentence_encoder import init_bert_params
-from fairseq.models.nat.nat_sd_shared import ModifiedLayerDropModuleList, _gumbel_softmax
+from fairseq.models.nat.nat_sd_shared import INV_SQRT2, ModifiedLayerDropModuleList, _gumbel_softmax
 from fairseq.models.nat import FairseqNATSharedDecoder, FairseqNATModel, ensemble_decoder
 from fairseq.models.transformer import Embedding
 
@@ -505,7 +505,7 @@ class NATransformerDecoder(FairseqNATSharedDecoder):
 
                 all_layer_output_logits.append(layer_out_logits)
                 if not self.concat_yhat:
-                    new_x = (x + layer_out) / torch.sqrt(torch.tensor(2.))
+                    new_x = (x + layer_out) * INV_SQRT2
                 else:
                     new_x = torch.cat((x, layer_out), dim=-1)
                     if self.concat_dropout is not None: